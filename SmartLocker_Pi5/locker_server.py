@@ -23,84 +23,349 @@ import os
 import sys
 import time
 import json
+import queue
+import fcntl
 import signal
+import select
+import socket
+import selectors
+import re
 import logging
+import logging.handlers
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
 try:
     import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection
+    from urllib3.util.retry import Retry
 except ImportError:
     print("ERROR: 'requests' library not found")
     print("Install with: pip3 install requests")
     sys.exit(1)
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Configuration
 RFCOMM_DEVICE = "/dev/rfcomm0"
-LOCAL_LOG_FILE = Path.home() / "smartlocker_log.json"
+LOCAL_LOG_FILE = Path.home() / "smartlocker_log.jsonl"
+LOCK_FILE = Path.home() / "smartlocker_server.lock"
+LOG_BUFFER_SIZE = 64 * 1024
+LOG_WRITE_INTERVAL = 0.1
+LOG_RETRY_INTERVAL = 5
+LOG_CLOSE_TIMEOUT = 5
+LOG_BUFFER_RECORDS = 100
+LOG_FLUSH_INTERVAL = 2
+LOG_COMPACT_MIN = 100
+LOG_MAX_BYTES = 1_000_000
+LOG_BACKUP_COUNT = 3
 WEBHOOK_TIMEOUT = 10
+# Whole budget for a borrow decision, redirect and connect retry included.
+# Must stay under the TTGO's 10 s AUTH_TIMEOUT_MS or a late answer is taken
+# as the reply to the next scan.
+BORROW_DEADLINE = 8
+BORROW_CONNECT_TIMEOUT = 2
 MAX_RETRIES = 3
 RETRY_DELAY = 1
+BREAKER_MAX_DELAY = 60
+DENY_CACHE_TTL = 2.0
+DENY_CACHE_TTL_UNREGISTERED = 10.0
+DENY_CACHE_SIZE = 256
+RFCOMM_READ_SIZE = 4096
+RFCOMM_WRITE_TIMEOUT = 2
+RECONNECT_INTERVAL = 1
+SYNC_INTERVAL = 60
+SYNC_BATCH_SIZE = 20
+FEATURE_RECHECK_INTERVAL = 300
+# [BORROW|RETURN,]{student_id} - student IDs are at least 8 alphanumerics
+COMMAND_RE = re.compile(rb'\s*(?:(BORROW|RETURN),)?([0-9A-Z]{8,})\s*$', re.IGNORECASE)
+RESPONSES = {'OK': b'OK\n', 'DENIED': b'DENIED\n'}
+# Single-student webhook bodies; IDs matched COMMAND_RE so need no escaping
+REQUEST_BODIES = {
+    action: b'{"action":"%s","student_id":"%%s"}' % action.encode('ascii')
+    for action in ('check_borrow', 'borrow_checked', 'borrow', 'return')
+}
 DEFAULT_WEBHOOK_URL = "https://script.google.com/macros/s/AKfycbwU7jvZcrGItGfxu3uS4Ux9vrXrL5ne9Lh0TXLLuW8OUCVsh6H6-UAUgRck5Nj89nfssw/exec"
 
+
+class BufferedFileHandler(logging.handlers.MemoryHandler):
+    """
+    File log that batches records instead of writing each one.
+    Flushes on WARNING and above, a full buffer, or at most
+    LOG_FLUSH_INTERVAL seconds after a record was buffered, even if
+    no further record arrives.
+    """
+    
+    def __init__(self, filename):
+        super().__init__(
+            capacity=LOG_BUFFER_RECORDS,
+            flushLevel=logging.WARNING,
+            target=logging.handlers.RotatingFileHandler(
+                filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+            )
+        )
+        self.last_flush = time.monotonic()
+        self.timer = None
+    
+    def shouldFlush(self, record):
+        return (super().shouldFlush(record)
+                or time.monotonic() - self.last_flush >= LOG_FLUSH_INTERVAL)
+    
+    def emit(self, record):
+        super().emit(record)
+        # An idle locker sends no next record to trigger the interval check
+        if self.buffer and self.timer is None:
+            self.timer = threading.Timer(LOG_FLUSH_INTERVAL, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+    
+    def flush(self):
+        self.acquire()
+        try:
+            super().flush()
+            self.last_flush = time.monotonic()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        finally:
+            self.release()
+
+
+# Records are formatted by the caller and written out by log_listener's
+# thread, so slow SD-card writes never stall the Bluetooth loop
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(
+    log_queue,
+    logging.StreamHandler(),
+    BufferedFileHandler(Path.home() / "smartlocker_server.log")
+)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler(Path.home() / "smartlocker_server.log")
-    ]
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
 logger = logging.getLogger(__name__)
 
 
+def dump_json(obj):
+    """Serialize to UTF-8 JSON bytes, using orjson when installed"""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+def load_json(data):
+    """Parse JSON from bytes, using orjson when installed"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 class LocalLog:
-    """Local log for offline operation and audit trail"""
+    """
+    Local log for offline operation and audit trail.
+    
+    Append-only JSONL file: one line per pending transaction, plus a
+    tombstone line ({"op": "del", ...}) when it has been synced. All disk
+    I/O happens on a writer thread that batches queued lines every
+    LOG_WRITE_INTERVAL; the file is rewritten once tombstones outnumber
+    the live entries.
+    """
     
     def __init__(self, filepath):
         self.filepath = Path(filepath)
-        self.pending_syncs = []
+        self.pending_syncs = OrderedDict()  # (action, student_id, timestamp) -> entry
+        self.file = None
+        self.lock = threading.Lock()
+        self._dead = 0
         self._load()
+        if self._dead:
+            self._compact(list(self.pending_syncs.values()))
+            self._dead = 0
+        else:
+            self.file = open(self.filepath, 'ab', buffering=LOG_BUFFER_SIZE)
+        
+        # Items are encoded lines, a list of entries to compact to, or None to stop
+        self._writeq = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='local-log', daemon=True)
+        self._writer.start()
     
     def _load(self):
-        if self.filepath.exists():
+        legacy = self.filepath.with_suffix('.json')
+        if not self.filepath.exists() and legacy.exists():
+            # Carry over entries from the old whole-file JSON log
             try:
-                with open(self.filepath, 'r') as f:
-                    data = json.load(f)
-                    self.pending_syncs = data.get('pending', [])
-                    logger.info(f"Loaded {len(self.pending_syncs)} pending syncs from local log")
+                with open(legacy, 'r') as f:
+                    for entry in json.load(f).get('pending', []):
+                        self.pending_syncs[self._key(entry)] = entry
+                legacy.rename(legacy.with_suffix('.json.bak'))
+                self._dead = 1  # forces a rewrite in the new format
+                logger.info(f"Migrated {len(self.pending_syncs)} pending syncs from {legacy}")
             except Exception as e:
-                logger.warning(f"Could not load local log: {e}")
-                self.pending_syncs = []
+                logger.warning(f"Could not migrate legacy log: {e}")
+            return
+        
+        if not self.filepath.exists():
+            return
+        
+        try:
+            with open(self.filepath, 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = load_json(line)
+                    except ValueError:
+                        # Torn write from a crash - dropped on compaction
+                        self._dead += 1
+                        continue
+                    
+                    if entry.get('op') == 'del':
+                        self._dead += 1
+                        if self.pending_syncs.pop(self._key(entry), None) is not None:
+                            self._dead += 1
+                    else:
+                        self.pending_syncs[self._key(entry)] = entry
+            logger.info(f"Loaded {len(self.pending_syncs)} pending syncs from local log")
+        except Exception as e:
+            logger.warning(f"Could not load local log: {e}")
+            self.pending_syncs = OrderedDict()
+    
+    @staticmethod
+    def _key(entry):
+        return (entry['action'], entry['student_id'], entry.get('timestamp'))
+    
+    def _write_loop(self):
+        batch = []  # items not yet safely on disk, oldest first
+        while True:
+            try:
+                # Wait for work, or only briefly if a failed batch needs a retry
+                batch.append(self._writeq.get(timeout=LOG_RETRY_INTERVAL if batch else None))
+                while True:
+                    batch.append(self._writeq.get_nowait())
+            except queue.Empty:
+                pass
+            
+            stopping = None in batch
+            if stopping:
+                batch = [item for item in batch if item is not None]
+            
+            try:
+                self._write(batch)
+                batch = []
+            except Exception as e:
+                # Keep the whole batch: lines written twice are harmless on replay
+                logger.error(f"Could not write local log: {e}")
+                self._drop_file()
+            
+            if stopping:
+                if batch:
+                    logger.error(f"{len(batch)} local log writes lost on shutdown")
+                self._drop_file()
+                return
+            
+            # Let bursts pile up so they share one write + fsync
+            time.sleep(LOG_WRITE_INTERVAL)
+    
+    def _write(self, batch):
+        if self.file is None:
+            self.file = open(self.filepath, 'ab', buffering=LOG_BUFFER_SIZE)
+        for item in batch:
+            if isinstance(item, list):
+                self._compact(item)
+            else:
+                self.file.write(item)
+        self._sync()
+    
+    def _drop_file(self):
+        if self.file:
+            f, self.file = self.file, None
+            try:
+                f.close()
+            except (OSError, ValueError):
+                pass
+    
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
     
-    def _save(self):
+    def _compact(self, entries):
+        """Rewrite the log with only the live entries"""
+        self._drop_file()
+        
+        tmp = self.filepath.with_suffix('.tmp')
         try:
-            with open(self.filepath, 'w') as f:
-                json.dump({
-                    'pending': self.pending_syncs,
-                    'last_updated': datetime.now().isoformat()
-                }, f, indent=2)
+            with open(tmp, 'wb') as f:
+                for entry in entries:
+                    f.write(dump_json(entry) + b"\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.filepath)
         except Exception as e:
-            logger.error(f"Could not save local log: {e}")
+            logger.error(f"Could not compact local log: {e}")
+        
+        self.file = open(self.filepath, 'ab', buffering=LOG_BUFFER_SIZE)
     
     def add_pending(self, action, student_id):
-        self.pending_syncs.append({
+        entry = {
             'action': action,
             'student_id': student_id,
             'timestamp': datetime.now().isoformat()
-        })
-        self._save()
+        }
+        with self.lock:
+            self.pending_syncs[self._key(entry)] = entry
+            self._writeq.put(dump_json(entry) + b"\n")
         logger.info(f"Added pending: {action} for {student_id}")
     
     def remove_pending(self, action, student_id):
-        self.pending_syncs = [
-            p for p in self.pending_syncs
-            if not (p['action'] == action and p['student_id'] == student_id)
-        ]
-        self._save()
+        """Drop the oldest pending entry for this action and student"""
+        with self.lock:
+            for key in self.pending_syncs:
+                if key[0] == action and key[1] == student_id:
+                    break
+            else:
+                return
+            
+            del self.pending_syncs[key]
+            self._writeq.put(dump_json({
+                'op': 'del',
+                'action': action,
+                'student_id': student_id,
+                'timestamp': key[2]
+            }) + b"\n")
+            self._dead += 2
+            if self._dead >= LOG_COMPACT_MIN and self._dead > len(self.pending_syncs):
+                self._writeq.put(list(self.pending_syncs.values()))
+                self._dead = 0
     
     def get_pending(self):
-        return self.pending_syncs.copy()
+        with self.lock:
+            return list(self.pending_syncs.values())
+    
+    def close(self):
+        """Write out everything queued and stop the writer thread"""
+        self._writeq.put(None)
+        self._writer.join(LOG_CLOSE_TIMEOUT)
+        if self._writer.is_alive():
+            logger.error("Local log writer did not stop in time")
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled sockets also have TCP keepalive enabled"""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        # urllib3's defaults already include TCP_NODELAY
+        kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        ]
+        super().init_poolmanager(*args, **kwargs)
 
 
 class WebhookClient:
@@ -108,33 +373,173 @@ class WebhookClient:
     
     def __init__(self, webhook_url):
         self.webhook_url = webhook_url
-        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='webhook')
+        # Optional actions the deployed script lacks -> when to try them again
+        self.unsupported = {}
+        self.deny_cache = OrderedDict()  # student_id -> (expires_at monotonic, reason), LRU order
+        self.cache_lock = threading.Lock()
+        # Circuit breaker: after failed calls, skip the network until open_until
+        self.fails = 0
+        self.open_until = 0.0
+        
+        # Warm connections to the Apps Script hosts; urllib3 handles retries
+        self.session = self._new_session(Retry(
+            total=MAX_RETRIES,
+            backoff_factor=RETRY_DELAY,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=["POST"],
+            raise_on_status=False
+        ))
+        # Check-and-set actions must not be resent: if the first attempt was
+        # recorded but its reply lost, the retry would be answered 'denied'.
+        # Only failed connects, where nothing was sent, are retried.
+        self.once = self._new_session(Retry(
+            total=1,
+            connect=1,
+            read=0,
+            status=0,
+            raise_on_status=False
+        ))
     
-    def _post(self, data):
-        """Make POST request with retries"""
-        for attempt in range(MAX_RETRIES):
-            try:
-                response = self.session.post(
+    @staticmethod
+    def _new_session(retry):
+        session = requests.Session()
+        session.headers['Connection'] = 'keep-alive'
+        session.headers['Content-Type'] = 'application/json'
+        # /exec answers every POST with a 302 to script.googleusercontent.com;
+        # the redirect host needs its own pool or each call evicts the other
+        session.mount('https://', KeepAliveAdapter(
+            pool_connections=2,
+            pool_maxsize=4,
+            max_retries=retry
+        ))
+        return session
+    
+    def _post(self, data, retry=True, deadline=None):
+        """
+        Make POST request (retries are done by the session adapter).
+        data is either a dict or an already encoded JSON body.
+        Pass retry=False for actions that are unsafe to send twice, and
+        deadline (seconds) to bound the whole call.
+        Returns None without calling out while the webhook is backed off.
+        """
+        if time.monotonic() < self.open_until:
+            return None
+        
+        if deadline is not None:
+            deadline += time.monotonic()
+        result = self._send(data, self.session if retry else self.once, deadline=deadline)
+        
+        if result is None:
+            self.fails += 1
+            delay = min(BREAKER_MAX_DELAY, 2 ** self.fails)
+            self.open_until = time.monotonic() + delay
+            logger.warning(f"Webhook failed {self.fails}x - backing off for {delay}s")
+        elif self.fails:
+            logger.info("Webhook reachable again")
+            self.fails = 0
+            self.open_until = 0.0
+        
+        return result
+    
+    @staticmethod
+    def _budget(deadline):
+        """(connect, read) timeouts that fit in what is left before deadline"""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise requests.exceptions.Timeout("borrow deadline passed")
+        # A slow connect retry can still overrun; _send rejects late replies
+        connect = min(BORROW_CONNECT_TIMEOUT, remaining / 4)
+        return connect, remaining - connect
+    
+    def _send(self, data, session, timeout=WEBHOOK_TIMEOUT, deadline=None):
+        """
+        POST data and return the reply object, or None on failure.
+        With a monotonic deadline, the POST and the /exec redirect it is
+        answered with share that one budget, and a reply that still
+        arrives after it counts as failed.
+        """
+        if not isinstance(data, bytes):
+            data = dump_json(data)
+        
+        try:
+            if deadline is None:
+                response = session.post(
                     self.webhook_url,
-                    json=data,
-                    timeout=WEBHOOK_TIMEOUT
+                    data=data,
+                    timeout=timeout
                 )
-                
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    logger.warning(f"Webhook returned {response.status_code}: {response.text}")
-                    
-            except requests.exceptions.Timeout:
-                logger.warning(f"Webhook timeout (attempt {attempt + 1}/{MAX_RETRIES})")
-            except requests.exceptions.RequestException as e:
-                logger.warning(f"Webhook error (attempt {attempt + 1}/{MAX_RETRIES}): {e}")
+            else:
+                response = session.post(
+                    self.webhook_url,
+                    data=data,
+                    allow_redirects=False,
+                    timeout=self._budget(deadline)
+                )
+                if response.is_redirect:
+                    response = session.get(
+                        response.headers['Location'],
+                        timeout=self._budget(deadline)
+                    )
+                if time.monotonic() > deadline:
+                    logger.warning("Webhook answered after the borrow deadline - ignoring reply")
+                    return None
+            
+            if response.status_code == 200:
+                result = load_json(response.content)
+                if isinstance(result, dict):
+                    return result
+                logger.warning(f"Webhook returned a non-object reply: {response.content[:200]!r}")
+            else:
+                logger.warning(f"Webhook returned {response.status_code}: {response.text}")
             
-            if attempt < MAX_RETRIES - 1:
-                time.sleep(RETRY_DELAY)
+        except requests.exceptions.Timeout:
+            logger.warning("Webhook timeout")
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Webhook error: {e}")
+        except ValueError:
+            # Apps Script serves an HTML error page with status 200
+            logger.warning(f"Webhook returned non-JSON: {response.content[:200]!r}")
         
         return None
     
+    def supports(self, action):
+        """False while an optional action is known to be missing from the webhook"""
+        retry_at = self.unsupported.get(action)
+        return retry_at is None or retry_at <= time.monotonic()
+    
+    def _mark_unsupported(self, action):
+        # Re-probe later so a redeployed script is picked up without a restart
+        self.unsupported[action] = time.monotonic() + FEATURE_RECHECK_INTERVAL
+    
+    @staticmethod
+    def _body(action, student_id):
+        return REQUEST_BODIES[action] % student_id.encode('ascii')
+    
+    def _cached_denial(self, student_id):
+        """Reason for a recent denial of this student, or None"""
+        with self.cache_lock:
+            entry = self.deny_cache.get(student_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.deny_cache[student_id]
+                return None
+            self.deny_cache.move_to_end(student_id)
+        
+        logger.info(f"Student {student_id} was denied recently - {entry[1]}")
+        return entry[1]
+    
+    def _cache_denial(self, student_id, reason):
+        # Approvals are never cached: borrowing changes the student's state
+        with self.cache_lock:
+            # Registration only changes on the sheet, so unknown cards can wait longer
+            ttl = DENY_CACHE_TTL_UNREGISTERED if reason == "not_registered" else DENY_CACHE_TTL
+            self.deny_cache[student_id] = (time.monotonic() + ttl, reason)
+            self.deny_cache.move_to_end(student_id)
+            if len(self.deny_cache) > DENY_CACHE_SIZE:
+                self.deny_cache.popitem(last=False)
+    
     def check_borrow(self, student_id):
         """
         Check if student can borrow.
@@ -144,12 +549,16 @@ class WebhookClient:
         - Student must EXIST in database
         - Student must NOT already have a box
         """
-        logger.info(f"Checking borrow eligibility for {student_id}")
+        reason = self._cached_denial(student_id)
+        if reason:
+            return False, reason
         
-        result = self._post({
-            'action': 'check_borrow',
-            'student_id': student_id
-        })
+        logger.debug("Checking borrow eligibility for %s", student_id)
+        
+        # The TTGO is waiting on this answer, so no retries
+        result = self._post(
+            self._body('check_borrow', student_id), retry=False, deadline=BORROW_DEADLINE
+        )
         
         if result:
             can_borrow = result.get('can_borrow', False)
@@ -158,48 +567,152 @@ class WebhookClient:
             # Check if this is a new student (not in database)
             if 'new student' in message.lower():
                 logger.info(f"Student {student_id} not found in database - DENIED")
+                self._cache_denial(student_id, "not_registered")
                 return False, "not_registered"
             
-            logger.info(f"Check result: can_borrow={can_borrow}, message={message}")
+            logger.debug("Check result: can_borrow=%s, message=%s", can_borrow, message)
             
             if can_borrow:
                 return True, "ok"
             else:
+                self._cache_denial(student_id, "already_borrowed")
                 return False, "already_borrowed"
         
         # Webhook unreachable - DENY for safety (can't verify student)
         logger.warning("Could not verify student - DENYING for safety")
         return False, "offline"
     
-    def record_borrow(self, student_id):
-        """Record a borrow transaction"""
-        logger.info(f"Recording borrow for {student_id}")
+    def borrow_atomic(self, student_id):
+        """
+        Check eligibility and record the borrow in a single round-trip.
+        Returns tuple: (approved: bool, reason: str), or None if the
+        deployed Apps Script does not support the 'borrow_checked' action.
         
-        result = self._post({
-            'action': 'borrow',
-            'student_id': student_id
-        })
+        Expected reply: {"status": "ok" | "denied", "reason": str}
+        """
+        if not self.supports('borrow_checked'):
+            return None
+        
+        reason = self._cached_denial(student_id)
+        if reason:
+            return False, reason
+        
+        logger.debug("Borrowing for %s", student_id)
+        
+        result = self._post(
+            self._body('borrow_checked', student_id), retry=False, deadline=BORROW_DEADLINE
+        )
+        
+        if result is None:
+            # Webhook unreachable - DENY for safety (can't verify student)
+            logger.warning("Could not verify student - DENYING for safety")
+            return False, "offline"
+        
+        status = result.get('status')
+        if status not in ('ok', 'denied'):
+            logger.info("Webhook has no borrow_checked action - using check_borrow + borrow")
+            self._mark_unsupported('borrow_checked')
+            return None
+        
+        logger.debug("Borrow result: %s", result)
+        
+        if status == 'ok':
+            return True, "ok"
+        
+        reason = result.get('reason') or "already_borrowed"
+        self._cache_denial(student_id, reason)
+        return False, reason
+    
+    def _record(self, action, student_id):
+        """Record a transaction, returns True on success"""
+        logger.debug("Recording %s for %s", action, student_id)
+        
+        result = self._post(self._body(action, student_id))
         
         if result:
-            logger.info(f"Borrow recorded: {result}")
+            logger.info(f"{action.capitalize()} recorded: {result}")
+            with self.cache_lock:
+                self.deny_cache.pop(student_id, None)
             return True
         
         return False
     
-    def record_return(self, student_id):
-        """Record a return transaction"""
-        logger.info(f"Recording return for {student_id}")
+    def _record_batch(self, ops):
+        """
+        Record several (action, student_id) transactions with one POST.
+        Returns a list of bools in the same order, or None if the deployed
+        Apps Script does not support the 'batch' action.
+        
+        Expected reply: {"results": [{"success": bool}, ...]}
+        """
+        logger.info(f"Recording batch of {len(ops)} transactions")
         
         result = self._post({
-            'action': 'return',
-            'student_id': student_id
-        })
+            'action': 'batch',
+            'ops': [{'action': action, 'student_id': student_id} for action, student_id in ops]
+        }, retry=False)
         
-        if result:
-            logger.info(f"Return recorded: {result}")
-            return True
+        if result is None:
+            return [False] * len(ops)
         
-        return False
+        results = result.get('results')
+        if not isinstance(results, list) or len(results) != len(ops):
+            logger.info("Webhook has no batch action - syncing one by one")
+            self._mark_unsupported('batch')
+            return None
+        
+        outcome = [isinstance(r, dict) and bool(r.get('success')) for r in results]
+        with self.cache_lock:
+            for (_, student_id), success in zip(ops, outcome):
+                if success:
+                    self.deny_cache.pop(student_id, None)
+        return outcome
+    
+    def _record_pending(self, ops):
+        """
+        Record queued (action, student_id) transactions in log order,
+        SYNC_BATCH_SIZE per call while the script has the 'batch' action
+        and one at a time otherwise. Stops at the first failure so a later
+        transaction never reaches the sheet before an earlier one.
+        Returns one bool per op.
+        """
+        results = []
+        while len(results) < len(ops):
+            rest = ops[len(results):]
+            if self.supports('batch'):
+                outcome = self._record_batch(rest[:SYNC_BATCH_SIZE])
+                if outcome is None:
+                    continue  # now marked unsupported
+            else:
+                outcome = [self._record(*rest[0])]
+            
+            results.extend(outcome)
+            if not all(outcome):
+                break
+        
+        return results + [False] * (len(ops) - len(results))
+    
+    def record_pending(self, ops):
+        """Replay queued transactions in order on one worker, returns a Future"""
+        return self.executor.submit(self._record_pending, ops)
+    
+    def record_borrow(self, student_id):
+        """Record a borrow transaction in the background, returns a Future"""
+        return self.executor.submit(self._record, 'borrow', student_id)
+    
+    def record_return(self, student_id):
+        """Record a return transaction in the background, returns a Future"""
+        return self.executor.submit(self._record, 'return', student_id)
+    
+    def prewarm(self):
+        """Open the HTTPS connection in the background so the first scan skips the handshake"""
+        # Warms the borrow-decision session; bypasses _post so a failure at
+        # boot (Wi-Fi still coming up) never trips the backoff
+        return self.executor.submit(self._send, {'action': 'test'}, self.once)
+    
+    def close(self):
+        """Wait for in-flight records to finish"""
+        self.executor.shutdown(wait=True)
 
 
 class LockerServer:
@@ -208,8 +721,24 @@ class LockerServer:
     def __init__(self, webhook_url):
         self.webhook = WebhookClient(webhook_url)
         self.local_log = LocalLog(LOCAL_LOG_FILE)
-        self.rfcomm = None
+        self.rfcomm = None  # raw non-blocking fd
+        self.rx_buffer = bytearray()
+        self.rx_chunk = bytearray(RFCOMM_READ_SIZE)  # reused by every read
+        self.rx_view = memoryview(self.rx_chunk)
+        self.syncing = set()
+        # Approved student IDs whose borrow record is not on the sheet yet
+        self.borrowing = {
+            item['student_id'] for item in self.local_log.get_pending()
+            if item['action'] == 'borrow'
+        }
         self.running = False
+        
+        # Single wait point for rfcomm data and stop() requests
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
     
     def open_rfcomm(self):
         try:
@@ -217,7 +746,8 @@ class LockerServer:
                 logger.info(f"Waiting for {RFCOMM_DEVICE}...")
                 return False
             
-            self.rfcomm = open(RFCOMM_DEVICE, 'r+b', buffering=0)
+            self.rfcomm = os.open(RFCOMM_DEVICE, os.O_RDWR | os.O_NONBLOCK)
+            self.selector.register(self.rfcomm, selectors.EVENT_READ)
             logger.info(f"Opened {RFCOMM_DEVICE}")
             return True
             
@@ -226,42 +756,92 @@ class LockerServer:
             return False
     
     def close_rfcomm(self):
-        if self.rfcomm:
+        if self.rfcomm is not None:
+            try:
+                self.selector.unregister(self.rfcomm)
+            except (KeyError, ValueError):
+                pass
             try:
-                self.rfcomm.close()
-            except:
+                os.close(self.rfcomm)
+            except OSError:
                 pass
             self.rfcomm = None
+            self.rx_buffer.clear()
     
     def send_response(self, response):
-        if self.rfcomm:
+        if self.rfcomm is not None:
             try:
-                msg = f"{response}\n".encode('utf-8')
-                self.rfcomm.write(msg)
-                self.rfcomm.flush()
-                logger.info(f"Sent to TTGO: {response}")
+                msg = RESPONSES.get(response) or f"{response}\n".encode('utf-8')
+                # One write per response; only loop if the tty took part of it
+                remaining = memoryview(msg)
+                while remaining:
+                    try:
+                        remaining = remaining[os.write(self.rfcomm, remaining):]
+                    except BlockingIOError:
+                        if not select.select([], [self.rfcomm], [], RFCOMM_WRITE_TIMEOUT)[1]:
+                            raise TimeoutError("rfcomm not writable")
+                logger.debug("Sent to TTGO: %s", response)
                 return True
             except Exception as e:
                 logger.error(f"Failed to send response: {e}")
         return False
     
+    def _record(self, action, student_id):
+        """Send a transaction to the webhook without blocking the read loop"""
+        if action == 'borrow':
+            future = self.webhook.record_borrow(student_id)
+        else:
+            future = self.webhook.record_return(student_id)
+        
+        future.add_done_callback(
+            lambda f: self._on_record_done(action, student_id, f)
+        )
+    
+    def _on_record_done(self, action, student_id, future):
+        """Runs on a webhook worker thread once a record call finishes"""
+        try:
+            success = future.result()
+        except Exception as e:
+            logger.error(f"Record {action} for {student_id} failed: {e}")
+            success = False
+        
+        if success:
+            if action == 'borrow':
+                self.borrowing.discard(student_id)
+            logger.info(f"{action.upper()} RECORDED for {student_id}")
+        else:
+            # Webhook down - log locally for later sync
+            self.local_log.add_pending(action, student_id)
+            logger.warning(f"{action.upper()} LOGGED LOCALLY for {student_id}")
+    
     def handle_borrow(self, student_id):
         """Handle a borrow request"""
         logger.info(f"=== BORROW REQUEST: {student_id} ===")
         
-        # Check if student can borrow
-        can_borrow, reason = self.webhook.check_borrow(student_id)
+        if student_id in self.borrowing:
+            # Approved, but the sheet does not show the borrow yet
+            result = (False, "already_borrowed")
+        else:
+            result = self.webhook.borrow_atomic(student_id)
+        
+        if result is None:
+            # Older Apps Script: check first, record separately
+            can_borrow, reason = self.webhook.check_borrow(student_id)
+            recorded = False
+        else:
+            can_borrow, reason = result
+            recorded = True
         
         if can_borrow:
-            # Record the borrow
-            if self.webhook.record_borrow(student_id):
+            if recorded:
                 self.send_response("OK")
-                logger.info(f"BORROW APPROVED for {student_id}")
             else:
-                # Webhook down for recording - still approve but log locally
-                self.local_log.add_pending('borrow', student_id)
+                # Approve right away; a separate record is written in the
+                # background and repeat scans are denied until it lands
+                self.borrowing.add(student_id)
                 self.send_response("OK")
-                logger.warning(f"BORROW APPROVED (logged locally) for {student_id}")
+                self._record('borrow', student_id)
+            logger.info(f"BORROW APPROVED for {student_id}")
         else:
             self.send_response("DENIED")
             if reason == "not_registered":
@@ -275,74 +855,104 @@ class LockerServer:
         """Handle a return notification"""
         logger.info(f"=== RETURN NOTIFICATION: {student_id} ===")
         
-        if self.webhook.record_return(student_id):
-            self.send_response("OK")
-            logger.info(f"RETURN RECORDED for {student_id}")
-        else:
-            # Webhook down - log locally for later sync
-            self.local_log.add_pending('return', student_id)
-            self.send_response("OK")
-            logger.warning(f"RETURN LOGGED LOCALLY for {student_id}")
+        self.send_response("OK")
+        self._record('return', student_id)
     
     def sync_pending(self):
         """Try to sync any pending local transactions"""
-        pending = self.local_log.get_pending()
-        if not pending:
+        if self.syncing:
+            # One replay at a time keeps the sheet in log order
             return
         
-        logger.info(f"Syncing {len(pending)} pending transactions...")
-        
-        for item in pending:
-            action = item['action']
-            student_id = item['student_id']
-            
-            success = False
-            if action == 'borrow':
-                success = self.webhook.record_borrow(student_id)
-            elif action == 'return':
-                success = self.webhook.record_return(student_id)
-            
-            if success:
-                self.local_log.remove_pending(action, student_id)
-                logger.info(f"Synced: {action} for {student_id}")
+        ops = []
+        for item in self.local_log.get_pending():
+            if item['action'] in ('borrow', 'return'):
+                ops.append((item['action'], item['student_id']))
             else:
-                logger.warning(f"Could not sync: {action} for {student_id}")
-    
-    def process_message(self, message):
-        """Process a message from TTGO"""
-        message = message.strip().upper()
-        
-        if not message:
+                logger.warning(f"Unknown pending action: {item['action']}")
+        ops = list(dict.fromkeys(ops))
+        if not ops:
             return
         
-        logger.info(f"Received from TTGO: {message}")
+        logger.info(f"Syncing {len(ops)} pending transactions...")
         
-        if ',' in message:
-            parts = message.split(',', 1)
-            command = parts[0]
-            student_id = parts[1] if len(parts) > 1 else ""
+        self.syncing.update(ops)
+        future = self.webhook.record_pending(ops)
+        future.add_done_callback(lambda f: self._on_sync_done(ops, f))
+    
+    def _on_sync_done(self, ops, future):
+        """Runs on a webhook worker thread once a replay finishes"""
+        try:
+            results = future.result()
+        except Exception as e:
+            logger.error(f"Sync failed: {e}")
+            results = [False] * len(ops)
+        
+        for (action, student_id), success in zip(ops, results):
+            self._sync_done(action, student_id, success)
+    
+    def _sync_done(self, action, student_id, success):
+        self.syncing.discard((action, student_id))
+        if success:
+            if action == 'borrow':
+                self.borrowing.discard(student_id)
+            self.local_log.remove_pending(action, student_id)
+            logger.info(f"Synced: {action} for {student_id}")
         else:
-            # Legacy: just a student ID (assume borrow)
-            command = "BORROW"
-            student_id = message
+            logger.warning(f"Could not sync: {action} for {student_id}")
+    
+    def process_message(self, raw):
+        """Process a raw line (bytes) from TTGO"""
+        match = COMMAND_RE.match(raw)
         
-        if not student_id or len(student_id) < 8:
-            logger.warning(f"Invalid student ID: {student_id}")
-            self.send_response("DENIED")
+        if not match:
+            if raw.strip():
+                logger.warning(f"Invalid message from TTGO: {raw!r}")
+                self.send_response("DENIED")
             return
         
+        # Legacy: just a student ID (assume borrow)
+        command = (match.group(1) or b"BORROW").decode('ascii').upper()
+        student_id = match.group(2).decode('ascii').upper()
+        
+        logger.debug("Received from TTGO: %s,%s", command, student_id)
+        
         if command == "BORROW":
             self.handle_borrow(student_id)
-        elif command == "RETURN":
-            self.handle_return(student_id)
         else:
-            logger.warning(f"Unknown command: {command}")
+            self.handle_return(student_id)
+    
+    def read_rfcomm(self):
+        """Drain rfcomm and handle every complete line"""
+        try:
+            count = os.readv(self.rfcomm, [self.rx_chunk])
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logger.error(f"Read error: {e}")
+            self.close_rfcomm()
+            return
+        
+        if not count:
+            logger.warning("TTGO disconnected")
+            self.close_rfcomm()
+            return
+        
+        buffer = self.rx_buffer
+        buffer += self.rx_view[:count]
+        while (end := buffer.find(b'\n')) != -1:
+            line = bytes(buffer[:end])
+            del buffer[:end + 1]
+            try:
+                self.process_message(line)
+            except Exception as e:
+                logger.error(f"Could not process message: {e}")
     
     def run(self):
         """Main server loop"""
         self.running = True
-        buffer = b""
-        last_sync_attempt = 0
+        next_sync = time.monotonic()
+        next_open = next_sync
         
         logger.info("=" * 50)
         logger.info("SmartLocker Pi Server Starting")
@@ -350,39 +960,29 @@ class LockerServer:
         logger.info(f"Device: {RFCOMM_DEVICE}")
         logger.info("=" * 50)
         
+        self.webhook.prewarm()
+        
         while self.running:
             try:
-                if not self.rfcomm:
+                now = time.monotonic()
+                if self.rfcomm is None and now >= next_open:
                     if not self.open_rfcomm():
-                        time.sleep(1)
-                        continue
+                        next_open = now + RECONNECT_INTERVAL
                 
-                now = time.time()
-                if now - last_sync_attempt > 60:
+                if now >= next_sync:
                     self.sync_pending()
-                    last_sync_attempt = now
+                    next_sync = now + SYNC_INTERVAL
                 
-                try:
-                    data = self.rfcomm.read(1)
-                    if data:
-                        if data == b'\n':
-                            try:
-                                message = buffer.decode('utf-8')
-                                self.process_message(message)
-                            except:
-                                pass
-                            buffer = b""
-                        elif data != b'\r':
-                            buffer += data
-                    else:
-                        logger.warning("TTGO disconnected")
-                        self.close_rfcomm()
-                        time.sleep(1)
-                        
-                except Exception as e:
-                    logger.error(f"Read error: {e}")
-                    self.close_rfcomm()
-                    time.sleep(1)
+                # Sleep until rfcomm has data, stop() is called, or a timer is due
+                deadline = next_sync if self.rfcomm is not None else min(next_sync, next_open)
+                timeout = max(0, deadline - time.monotonic())
+                for key, _ in self.selector.select(timeout):
+                    if key.fd == self.wakeup_r:
+                        os.read(self.wakeup_r, 64)
+                    elif self.rfcomm is not None:
+                        self.read_rfcomm()
+                        if self.rfcomm is None:
+                            next_open = time.monotonic() + RECONNECT_INTERVAL
                     
             except KeyboardInterrupt:
                 logger.info("Shutting down...")
@@ -390,16 +990,33 @@ class LockerServer:
                 
             except Exception as e:
                 logger.error(f"Server error: {e}")
-                time.sleep(1)
+                # Back off without ignoring stop()
+                select.select([self.wakeup_r], [], [], RECONNECT_INTERVAL)
         
         self.close_rfcomm()
+        self.webhook.close()
+        self.local_log.close()
         logger.info("Server stopped")
     
     def stop(self):
         self.running = False
+        try:
+            os.write(self.wakeup_w, b'\0')
+        except OSError:
+            pass
 
 
 def main():
+    # Only one server may read /dev/rfcomm0; the lock is released on exit
+    lock_file = open(LOCK_FILE, 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        print(f"ERROR: another SmartLocker server is running (lock: {LOCK_FILE})")
+        sys.exit(1)
+    
+    log_listener.start()
+    
     if len(sys.argv) > 1:
         webhook_url = sys.argv[1]
     else:
@@ -415,7 +1032,10 @@ def main():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     
-    server.run()
+    try:
+        server.run()
+    finally:
+        log_listener.stop()
 
 
 if __name__ == "__main__":